@@ -13,6 +13,7 @@ from .calibration import calibration_download, calibration_upload
 from .utils import (
     create_logger,
     download_file,
+    download_files,
     upload_file,
     extract_article_metadata,
     validate_experiment_metadata,
@@ -27,6 +28,7 @@ __all__ = [
     "calibration_upload",
     "create_logger",
     "download_file",
+    "download_files",
     "upload_file",
     "extract_article_metadata",
     "validate_experiment_metadata",
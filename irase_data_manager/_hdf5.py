@@ -0,0 +1,314 @@
+"""
+Auxiliary functions to write HDF5 datasets
+"""
+
+import itertools
+import json
+import math
+import os
+import zlib
+from collections.abc import Callable, Iterable
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+
+import h5py
+import numpy as np
+
+
+def write_chunked_dataset(
+    group: h5py.Group,
+    name: str,
+    data: np.ndarray,
+    chunks: tuple[int, ...] | None = None,
+    compression_level: int = 4,
+    max_workers: int | None = None,
+) -> h5py.Dataset:
+    """Create a shuffled and gzip compressed dataset and fill it with chunks compressed in parallel.
+
+    Writing through ``create_dataset(data=...)`` runs every chunk through the HDF5 filter pipeline, one after the other, in the calling thread. Instead, the chunks are compressed with ``zlib`` in a thread pool (``zlib`` releases the GIL while compressing) and the compressed bytes are written as they are ready with ``write_direct_chunk``. The resulting dataset is a regular gzip dataset, so it can be read with any HDF5 library.
+
+    .. note::
+
+        Scalar, empty and non-numeric arrays are written with ``create_dataset`` as usual, as they can not be chunked.
+
+    Args:
+        group (h5py.Group): The group (or file) where the dataset is created.
+        name (str): The name of the dataset.
+        data (np.ndarray): The data to write.
+        chunks (tuple[int, ...] | None, optional): The shape of the chunks. Defaults to None, which uses :func:`auto_chunk`.
+        compression_level (int, optional): The gzip compression level, from 0 to 9. Defaults to 4.
+        max_workers (int | None, optional): The number of threads used to compress the chunks. Defaults to None, which lets ``ThreadPoolExecutor`` decide.
+
+    Returns:
+        h5py.Dataset: The created dataset.
+    """
+    data = np.asarray(data)
+
+    if not can_chunk(data):
+        return group.create_dataset(name, data=data, track_times=False)
+
+    dataset = create_chunked_dataset(
+        group, name, data.shape, data.dtype, chunks, compression_level
+    )
+    write_chunks(dataset, data, max_workers=max_workers)
+
+    return dataset
+
+
+def can_chunk(data: np.ndarray) -> bool:
+    """Check whether the data can be written with :func:`write_chunks`.
+
+    Args:
+        data (np.ndarray): The data to check.
+
+    Returns:
+        bool: True if the data is a non-empty numeric array with at least one dimension.
+    """
+    return data.ndim > 0 and data.size > 0 and data.dtype.kind in "biufc"
+
+
+def create_chunked_dataset(
+    group: h5py.Group,
+    name: str,
+    shape: tuple[int, ...],
+    dtype: np.dtype,
+    chunks: tuple[int, ...] | None = None,
+    compression_level: int = 4,
+) -> h5py.Dataset:
+    """Create an empty shuffled and gzip compressed dataset, to be filled with :func:`write_chunks`.
+
+    The modification times of the dataset are not stored, so writing it does not update them.
+
+    Args:
+        group (h5py.Group): The group (or file) where the dataset is created.
+        name (str): The name of the dataset.
+        shape (tuple[int, ...]): The shape of the dataset.
+        dtype (np.dtype): The data type of the dataset.
+        chunks (tuple[int, ...] | None, optional): The shape of the chunks. Defaults to None, which uses :func:`auto_chunk`.
+        compression_level (int, optional): The gzip compression level, from 0 to 9. Defaults to 4.
+
+    Returns:
+        h5py.Dataset: The created dataset.
+    """
+    dtype = np.dtype(dtype)
+
+    if chunks is None:
+        chunks = auto_chunk(shape, dtype.itemsize)
+
+    return group.create_dataset(
+        name,
+        shape=shape,
+        dtype=dtype,
+        chunks=chunks,
+        compression="gzip",
+        compression_opts=compression_level,
+        shuffle=True,
+        track_times=False,
+    )
+
+
+def write_chunks(
+    dataset: h5py.Dataset,
+    data: np.ndarray,
+    offset: tuple[int, ...] | None = None,
+    max_workers: int | None = None,
+) -> None:
+    """Compress the data in a thread pool and write it into a dataset created with :func:`create_chunked_dataset`.
+
+    .. warning::
+
+        The offset has to be aligned with the chunks of the dataset, and the data has to cover whole chunks, except at the edges of the dataset. Otherwise, the data of the partially covered chunks is lost.
+
+    Args:
+        dataset (h5py.Dataset): The dataset to write to.
+        data (np.ndarray): The data to write. It must have the same number of dimensions as the dataset.
+        offset (tuple[int, ...] | None, optional): The position of the first element of the data in the dataset. Defaults to None, which is the origin.
+        max_workers (int | None, optional): The number of threads used to compress the chunks. Defaults to None, which lets ``ThreadPoolExecutor`` decide.
+    """
+    data = np.asarray(data)
+
+    if offset is None:
+        offset = (0,) * data.ndim
+
+    write_chunk_pieces(dataset, [(offset, data)], max_workers=max_workers)
+
+
+def write_chunk_pieces(
+    dataset: h5py.Dataset,
+    pieces: Iterable[tuple[tuple[int, ...], np.ndarray]],
+    max_workers: int | None = None,
+    on_piece_done: Callable[[], None] | None = None,
+) -> None:
+    """Write several pieces of data into a dataset created with :func:`create_chunked_dataset`, as :func:`write_chunks` does for each of them.
+
+    The chunks of all the pieces are compressed in the same thread pool, so writing many small pieces does not create a thread pool for each one, nor waits for a piece to be written before compressing the next one. Only about two chunks per thread are compressed ahead of the writes, and each chunk is released once it is written, so the compressed chunks of a large dataset are not all kept in memory.
+
+    Args:
+        dataset (h5py.Dataset): The dataset to write to.
+        pieces (Iterable[tuple[tuple[int, ...], np.ndarray]]): The offset and data of each piece, with the same requirements as in :func:`write_chunks`.
+        max_workers (int | None, optional): The number of threads used to compress the chunks. Defaults to None, which uses the default of ``ThreadPoolExecutor``.
+        on_piece_done (Callable[[], None] | None, optional): A function called every time all the chunks of a piece are written, e.g., to update a progress bar. Defaults to None.
+    """
+    chunks = dataset.chunks
+    compression_level = dataset.compression_opts
+
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+
+    # Compressed chunks that are not written yet, with their offset in the dataset
+    # and the index of their piece, and the number of chunks left of each piece
+    pending = {}
+    remaining = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for piece, (offset, data) in enumerate(pieces):
+            data = np.asarray(data, dtype=dataset.dtype)
+            chunk_offsets = list(_chunk_offsets(data.shape, chunks))
+
+            remaining[piece] = len(chunk_offsets)
+            if not chunk_offsets and on_piece_done is not None:
+                on_piece_done()
+
+            for chunk_offset in chunk_offsets:
+                if len(pending) >= 2 * max_workers:
+                    _write_completed(
+                        dataset, pending, remaining, on_piece_done, FIRST_COMPLETED
+                    )
+
+                future = executor.submit(
+                    _compress_chunk, data, chunk_offset, chunks, compression_level
+                )
+                pending[future] = (
+                    tuple(start + shift for start, shift in zip(chunk_offset, offset)),
+                    piece,
+                )
+
+        _write_completed(dataset, pending, remaining, on_piece_done, ALL_COMPLETED)
+
+
+def coerce_attrs(metadata: dict[str, any]) -> dict[str, any]:
+    """Convert metadata values that HDF5 attributes can not store consistently.
+
+    Lists, tuples and dictionaries are stored as JSON strings, so nested or mixed values (e.g., a list of dictionaries) can always be stored, and they are always read back the same way. Other values are kept as they are.
+
+    Args:
+        metadata (dict[str, any]): The metadata to store as attributes.
+
+    Returns:
+        dict[str, any]: The metadata, ready to be passed to ``attrs.update``.
+    """
+    return {
+        key: json.dumps(value) if isinstance(value, (list, tuple, dict)) else value
+        for key, value in metadata.items()
+    }
+
+
+def auto_chunk(
+    shape: tuple[int, ...], itemsize: int, target: int = 1 << 20
+) -> tuple[int, ...]:
+    """Choose a chunk shape of about ``target`` bytes for a dataset.
+
+    The axes are halved starting from the first one, so the chunks keep whole rows (the last axes) for as long as possible. This matches the expected access pattern of the uploaded data: either the full array or a slice of rows is read at once.
+
+    Args:
+        shape (tuple[int, ...]): The shape of the dataset.
+        itemsize (int): The size in bytes of one element of the dataset.
+        target (int, optional): The maximum size in bytes of a chunk. Defaults to 1 MB.
+
+    Returns:
+        tuple[int, ...]: The shape of the chunks.
+    """
+    chunks = list(shape)
+
+    for axis in range(len(chunks)):
+        while chunks[axis] > 1 and math.prod(chunks) * itemsize > target:
+            chunks[axis] = (chunks[axis] + 1) // 2
+
+    return tuple(chunks)
+
+
+def _chunk_offsets(
+    shape: tuple[int, ...], chunks: tuple[int, ...]
+) -> itertools.product:
+    """Iterate over the offsets of all the chunks of a dataset, in C order.
+
+    Args:
+        shape (tuple[int, ...]): The shape of the dataset.
+        chunks (tuple[int, ...]): The shape of the chunks of the dataset.
+
+    Returns:
+        itertools.product: The offset of each chunk, as a tuple of ints.
+    """
+    return itertools.product(
+        *[range(0, size, chunk) for size, chunk in zip(shape, chunks)]
+    )
+
+
+def _write_completed(
+    dataset: h5py.Dataset,
+    pending: dict[Future, tuple[tuple[int, ...], int]],
+    remaining: dict[int, int],
+    on_piece_done: Callable[[], None] | None,
+    return_when: str,
+) -> None:
+    """Wait for compressed chunks and write them into the dataset, removing them from the pending ones.
+
+    Args:
+        dataset (h5py.Dataset): The dataset to write to.
+        pending (dict[Future, tuple[tuple[int, ...], int]]): The futures of the compressed chunks, with their offset in the dataset and the index of their piece.
+        remaining (dict[int, int]): The number of chunks left to write of each piece, updated with the written chunks.
+        on_piece_done (Callable[[], None] | None): The function called when all the chunks of a piece are written.
+        return_when (str): When to stop waiting, ``FIRST_COMPLETED`` or ``ALL_COMPLETED``.
+    """
+    done, _ = wait(pending, return_when=return_when)
+
+    for future in done:
+        offset, piece = pending.pop(future)
+        dataset.id.write_direct_chunk(offset, future.result())
+
+        remaining[piece] -= 1
+        if remaining[piece] == 0:
+            del remaining[piece]
+            if on_piece_done is not None:
+                on_piece_done()
+
+
+def _compress_chunk(
+    data: np.ndarray,
+    offset: tuple[int, ...],
+    chunks: tuple[int, ...],
+    compression_level: int,
+) -> bytes:
+    """Compress the chunk of the data starting at the given offset.
+
+    HDF5 always stores full chunks, so the chunks at the edges of the data are padded with zeros. The bytes are shuffled before compressing, as the HDF5 shuffle filter would do.
+
+    Args:
+        data (np.ndarray): The full data.
+        offset (tuple[int, ...]): The offset of the chunk.
+        chunks (tuple[int, ...]): The shape of the chunks.
+        compression_level (int): The gzip compression level.
+
+    Returns:
+        bytes: The compressed chunk, in the format expected by the HDF5 shuffle and deflate filters.
+    """
+    tile = data[
+        tuple(slice(start, start + size) for start, size in zip(offset, chunks))
+    ]
+
+    if tile.shape != chunks:
+        padded_tile = np.zeros(chunks, dtype=data.dtype)
+        padded_tile[tuple(slice(0, size) for size in tile.shape)] = tile
+        tile = padded_tile
+
+    # The shuffle filter groups the n-th byte of every element together
+    shuffled_tile = (
+        np.ascontiguousarray(tile).view(np.uint8).reshape(-1, data.dtype.itemsize).T
+    )
+
+    return zlib.compress(np.ascontiguousarray(shuffled_tile), compression_level)
@@ -0,0 +1,72 @@
+"""
+Shared HTTP session for the requests to the Figshare API
+"""
+
+import functools
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds, used in every request
+TIMEOUT = (5, 60)
+
+
+@functools.cache
+def get_session() -> requests.Session:
+    """Get the session shared by all the requests to the Figshare API.
+
+    A single session reuses the connections (and TLS handshakes) across requests. It is created on the first call, with a pool of 16 connections and retries with backoff on connection errors and on the status codes of transient failures. When the retries run out on one of those status codes, the last response is returned, so the callers check its status code as usual.
+
+    Returns:
+        requests.Session: The shared session.
+    """
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                raise_on_status=False,
+            ),
+        ),
+    )
+
+    return session
+
+
+def auth_headers(auth_token: str) -> dict[str, str]:
+    """Build the headers to authenticate a request with a token.
+
+    Args:
+        auth_token (str): The authentication token. If empty, the request is not authenticated.
+
+    Returns:
+        dict[str, str]: The headers, without an ``Authorization`` header if there is no token.
+    """
+    if not auth_token:
+        return {}
+
+    return {"Authorization": f"token {auth_token}"}
+
+
+def figshare_files_url(article_id: int, auth_token: str) -> tuple[str, dict[str, str]]:
+    """Build the URL and headers to list the files of an article.
+
+    Private articles are listed from the account endpoint, which requires a token. Without a token, the article is assumed to be public.
+
+    Args:
+        article_id (int): The ID of the article.
+        auth_token (str): The authentication token. If empty, the article is assumed to be public.
+
+    Returns:
+        tuple[str, dict[str, str]]: The URL and the headers of the request.
+    """
+    account = "account/" if auth_token else ""
+    url = f"https://api.figshare.com/v2/{account}articles/{article_id}/files"
+
+    return url, auth_headers(auth_token)
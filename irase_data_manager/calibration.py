@@ -2,17 +2,18 @@
 
 import os
 import logging
-import requests
 from tqdm import tqdm
 import numpy as np
-import irase_data_manager
+from .utils import create_logger, download_files, upload_file, _expect
+from ._http import get_session, TIMEOUT, figshare_files_url
+from ._hdf5 import write_chunked_dataset
 import h5py
 
 
 def calibration_download(
     article_id: int,
     auth_token: str = "",
-    save_path: os.PathLike = os.getcwd(),
+    save_path: os.PathLike | None = None,
     verbose: bool = False,
 ) -> None:
     """Download calibration data from the i-RASE 3DCZT software.
@@ -20,45 +21,42 @@ def calibration_download(
     Args:
         article_id (int): The ID of the article to download the data from.
         auth_token (str, optional): The authentication token for accessing the platform. Defaults to "".
-        save_path (os.PathLike, optional): The path to save the downloaded file. Defaults to the current working directory.
+        save_path (os.PathLike | None, optional): The path to save the downloaded file. Defaults to None, which is the current working directory.
         verbose (bool, optional): Whether to display verbose output. Defaults to False.
     """
-    logger = irase_data_manager.create_logger("download_calibration")
+    if save_path is None:
+        save_path = os.getcwd()
+
+    logger = create_logger("download_calibration")
 
     if verbose:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
 
-    article_url = f"https://api.figshare.com/v2/account/articles/{article_id}/files"
-    if auth_token == "":
+    if not auth_token:
         logger.debug("No authentication token provided. Assuming public data.")
-        article_url = f"https://api.figshare.com/v2/articles/{article_id}/files"
 
-    headers = {"Authorization": f"token {auth_token}"}
-    response = requests.get(article_url, headers=headers)
+    article_url, headers = figshare_files_url(article_id, auth_token)
+    response = get_session().get(article_url, headers=headers, timeout=TIMEOUT)
 
     logger.debug("Downloading calibration data from the i-RASE 3DCZT software")
 
-    if response.status_code != 200:
-        data = response.json()
-        raise RuntimeError(f"Failed to fetch data from {article_url}: {data}")
+    _expect(response, 200, f"Failed to fetch data from {article_url}")
 
     files = response.json()
 
     logger.debug(f"Found {len(files)} files in the response")
 
-    for file in files:
-        irase_data_manager.download_file(
-            file, save_path, auth_token=auth_token, verbose=verbose
-        )
+    download_files(files, save_path, auth_token=auth_token, verbose=verbose)
 
 
 def calibration_upload(
     calibration_data: list[tuple[np.ndarray]],
     auth_token: str = "",
-    save_path: os.PathLike = os.getcwd(),
+    save_path: os.PathLike | None = None,
     verbose: bool = False,
+    chunk_shape: tuple[int, ...] | None = None,
 ):
     """Upload calibration data to the calibration.hdf5 file.
 
@@ -76,15 +74,19 @@ def calibration_upload(
     Args:
         calibration_data (list[tuple[np.ndarray, np.ndarray]]): List of calibration data.
         auth_token (str, optional): The authentication token for accessing the platform. Defaults to "".
-        save_path (os.PathLike, optional): The path to save the calibration file. Defaults to the current working directory.
+        save_path (os.PathLike | None, optional): The path to save the calibration file. Defaults to None, which is the current working directory.
         verbose (bool, optional): Whether to display verbose output. Defaults to False.
+        chunk_shape (tuple[int, ...] | None, optional): The shape of the HDF5 chunks of the "k1" and "k2" datasets. Defaults to None, which chooses chunks of about 1 MB.
 
     Raises:
         RuntimeError: If the upload of the calibration data fails.
 
     """
 
-    logger = irase_data_manager.create_logger("upload_calibration")
+    if save_path is None:
+        save_path = os.getcwd()
+
+    logger = create_logger("upload_calibration")
 
     if verbose:
         logger.setLevel(logging.DEBUG)
@@ -97,17 +99,19 @@ def calibration_upload(
 
     file_path = os.path.join(save_path, "calibration.hdf5")
 
-    with h5py.File(file_path, "w") as f:
+    with h5py.File(file_path, "w", libver="latest") as f:
         for i, array in tqdm(
             enumerate(calibration_data),
             desc="Uploading calibration data to calibration.hdf5",
             disable=not verbose,
             total=len(calibration_data),
+            mininterval=0.1,
+            smoothing=0.05,
         ):
             group_name = f"D{i + 1}"
             f.create_group(group_name)
-            f[group_name].create_dataset("k1", data=array[0])
-            f[group_name].create_dataset("k2", data=array[1])
+            write_chunked_dataset(f[group_name], "k1", array[0], chunks=chunk_shape)
+            write_chunked_dataset(f[group_name], "k2", array[1], chunks=chunk_shape)
 
     logger.debug("Calibration data uploaded successfully")
 
@@ -124,15 +128,15 @@ def calibration_upload(
 
     # Create a new article for the calibration data
     create_article_url = "https://api.figshare.com/v2/account/projects/211264/articles"
-    response = requests.post(create_article_url, headers=headers, json=article_metadata)
+    response = get_session().post(
+        create_article_url, headers=headers, json=article_metadata, timeout=TIMEOUT
+    )
 
-    if response.status_code != 201:
-        data = response.json()
-        raise RuntimeError(f"Failed to create article: {data}")
+    _expect(response, 201, "Failed to create article")
 
     article_id = response.json()["entity_id"]
 
     # Upload the calibration file
-    irase_data_manager.upload_file(file_path, auth_token, article_id, verbose=verbose)
+    upload_file(file_path, auth_token, article_id, verbose=verbose)
 
     logger.debug(f"Calibration data uploaded successfully with article ID {article_id}")
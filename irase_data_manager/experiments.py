@@ -5,8 +5,23 @@ Download and upload data from the experimental setup of the i-RASE project
 import os
 import h5py
 import numpy as np
-import requests
-import irase_data_manager
+from .utils import (
+    create_logger,
+    download_files,
+    upload_file,
+    extract_article_metadata,
+    validate_experiment_metadata,
+    _expect,
+)
+from ._http import get_session, TIMEOUT, figshare_files_url
+from ._hdf5 import (
+    auto_chunk,
+    can_chunk,
+    coerce_attrs,
+    create_chunked_dataset,
+    write_chunk_pieces,
+    write_chunked_dataset,
+)
 import logging
 from tqdm import tqdm
 
@@ -14,7 +29,7 @@ from tqdm import tqdm
 def download_data(
     article_id: int,
     auth_token: str = "",
-    save_path: os.PathLike = os.getcwd(),
+    save_path: os.PathLike | None = None,
     verbose: bool = False,
 ) -> None:
     """Download data from the experimental setup of the i-RASE project. For now, we require the article id to download the data.
@@ -30,7 +45,7 @@ def download_data(
     Args:
         article_id (int): The ID of the article to download the data from.
         auth_token (str): The authentication token for accessing the platform. Defaults to an empty string.
-        save_path (os.PathLike, optional): The path to save the downloaded file. Defaults to the current working directory.
+        save_path (os.PathLike | None, optional): The path to save the downloaded file. Defaults to None, which is the current working directory.
         verbose (bool, optional): Whether to display verbose output. Defaults to False.
 
     Raises:
@@ -38,41 +53,38 @@ def download_data(
         RuntimeError: If the download of the file fails.
     """
 
-    logger = irase_data_manager.create_logger(f"download_data_{article_id}")
+    if save_path is None:
+        save_path = os.getcwd()
+
+    logger = create_logger("download_experimental_data")
 
     if verbose:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
 
-    article_url = f"https://api.figshare.com/v2/account/articles/{article_id}/files"  # Private data URL
-    if auth_token == "":
+    if not auth_token:
         # We assume that if no auth_token is provided, the data is public
         logger.debug("No authentication token provided. Assuming public data.")
-        article_url = f"https://api.figshare.com/v2/articles/{article_id}/files"  # Public data URL
 
-    headers = {"Authorization": f"token {auth_token}"}
-    response = requests.get(article_url, headers=headers)
+    article_url, headers = figshare_files_url(article_id, auth_token)
+    response = get_session().get(article_url, headers=headers, timeout=TIMEOUT)
 
-    if response.status_code != 200:
-        data = response.json()
-        raise RuntimeError(f"Failed to fetch data from {article_url}: {data}")
+    _expect(response, 200, f"Failed to fetch data from {article_url}")
 
     files = response.json()
-    logger.debug(f"Found {len(files)} files in the response")
+    logger.debug(f"Found {len(files)} files in article {article_id}")
 
-    for file in files:
-        irase_data_manager.download_file(
-            file, save_path, auth_token=auth_token, verbose=verbose
-        )
+    download_files(files, save_path, auth_token=auth_token, verbose=verbose)
 
 
 def upload_data(
     data: list[np.ndarray],
     auth_token: str,
     metadata: dict[str, any],
-    save_path: str = os.getcwd(),
+    save_path: str | None = None,
     verbose: bool = False,
+    chunk_shape: tuple[int, ...] | None = None,
 ) -> os.PathLike:
     """Upload data from the experimental setup of the i-RASE project to the DTU Data platform.
 
@@ -104,15 +116,18 @@ def upload_data(
             - Irfan Kuvvetli: 6213518
             - Alejandro Valverde Mahou: 18722368
 
-    If any other metadata is added, it will be stored in the ``.hdf5`` file as attributes.
+    If any other metadata is added, it will be stored in the ``.hdf5`` file as attributes. Lists and dictionaries are stored as JSON strings.
+
+    If all the arrays have the same shape and data type, they are stored stacked in a single dataset, ``arrays``, so ``arrays[i]`` is the i-th array. Otherwise, each array is stored in its own dataset, ``array_{i}``.
 
 
     Args:
         data (list[np.ndarray]): A list of numpy arrays containing the experimental data, ordered as they were obtained.
         auth_token (str): The authentication token for accessing the platform.
         metadata (dict[str, any]): The metadata of the article, as described above.
-        save_path (str, optional): The path to save the uploaded file. Defaults to the current working directory.
+        save_path (str | None, optional): The path to save the uploaded file. Defaults to None, which is the current working directory.
         verbose (bool, optional): Whether to display verbose output. Defaults to False.
+        chunk_shape (tuple[int, ...] | None, optional): The shape of the HDF5 chunks of the datasets. Defaults to None, which chooses chunks of about 1 MB.
 
     Returns:
         os.PathLike: The path to the file uploaded locally saved.
@@ -123,52 +138,92 @@ def upload_data(
         RuntimeError: If the creation of the article fails.
     """
 
-    logger = irase_data_manager.create_logger("upload_experimental_data")
+    if save_path is None:
+        save_path = os.getcwd()
+
+    logger = create_logger("upload_experimental_data")
 
     if verbose:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
 
-    print(metadata)
+    logger.debug(f"Uploading experimental data with metadata: {metadata}")
 
-    article_metadata = irase_data_manager.extract_article_metadata(metadata)
-    irase_data_manager.validate_experiment_metadata(metadata)
+    article_metadata = extract_article_metadata(metadata)
+    validate_experiment_metadata(metadata)
 
     logger.debug("Transforming data into a single HDF5 file")
 
     file_name = "test_data.hdf5"  # NOTE: Update when naming convention is decided
     file_path = os.path.join(save_path, file_name)
 
-    with h5py.File(file_path, "w") as f:
-        for i, array in tqdm(
-            enumerate(data),
-            desc=f"Uploading data to {file_name}",
-            disable=not verbose,
-            total=len(data),
-        ):
-            f.create_dataset(
-                f"array_{i}", data=array
+    arrays = [np.asarray(array) for array in data]
+    stack_arrays = (
+        len(arrays) > 0
+        and can_chunk(arrays[0])
+        and all(
+            array.shape == arrays[0].shape and array.dtype == arrays[0].dtype
+            for array in arrays
+        )
+    )
+
+    with h5py.File(file_path, "w", libver="latest") as f:
+        if stack_arrays:
+            # A single dataset avoids creating one dataset per array
+            array_chunks = chunk_shape or auto_chunk(
+                arrays[0].shape, arrays[0].dtype.itemsize
+            )
+            dataset = create_chunked_dataset(
+                f,
+                "arrays",
+                (len(arrays), *arrays[0].shape),
+                arrays[0].dtype,
+                chunks=(1, *array_chunks),
             )  # NOTE: Update when naming convention is decided
 
-        for key, value in metadata.items():
-            f.attrs[key] = value
+        with tqdm(
+            desc=f"Uploading data to {file_name}",
+            disable=not verbose,
+            total=len(arrays),
+            mininterval=0.1,
+            smoothing=0.05,
+        ) as progress:
+            if stack_arrays:
+                # The chunks of all the arrays are compressed in a single thread pool,
+                # and the progress advances when all the chunks of an array are written
+                write_chunk_pieces(
+                    dataset,
+                    (
+                        ((i,) + (0,) * array.ndim, array[np.newaxis])
+                        for i, array in enumerate(arrays)
+                    ),
+                    on_piece_done=progress.update,
+                )
+            else:
+                for i, array in enumerate(arrays):
+                    write_chunked_dataset(
+                        f, f"array_{i}", array, chunks=chunk_shape
+                    )  # NOTE: Update when naming convention is decided
+                    progress.update()
+
+        f.attrs.update(coerce_attrs(metadata))
 
     logger.debug("Data transformed successfully")
 
     headers = {"Authorization": f"token {auth_token}"}
 
     create_article_url = "https://api.figshare.com/v2/account/projects/211264/articles"
-    response = requests.post(create_article_url, headers=headers, json=article_metadata)
+    response = get_session().post(
+        create_article_url, headers=headers, json=article_metadata, timeout=TIMEOUT
+    )
 
-    if response.status_code != 201:
-        data = response.json()
-        raise RuntimeError(f"Failed to create article: {data}")
+    _expect(response, 201, "Failed to create article")
 
     article_id = response.json()["entity_id"]
 
     logger.debug(f"Article created successfully with id {article_id}")
 
-    irase_data_manager.upload_file(file_path, auth_token, article_id, verbose=verbose)
+    upload_file(file_path, auth_token, article_id, verbose=verbose)
 
     return file_path
@@ -1,21 +1,70 @@
 """
-Download and upload data from the i-RASE project on the DTU Data platform 
+Download and upload data from the i-RASE project on the DTU Data platform
 """
 
-import irase_data_manager
+from .utils import create_logger, download_files, upload_file, _expect
+from ._http import get_session, TIMEOUT, figshare_files_url
 import os
-import requests
+import json
 import logging
+import math
+import re
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import pandas as pd
 import time
 import h5py
 
+# Number of bytes of the input data reshaped at once
+_RESHAPE_SLAB_BYTES = 64 * 1024 * 1024
+
+# The group of the HDF5 file where the data of each COMSOL file is stored, by the
+# prefix of the file name, e.g., `AW` for `AW_3D.txt`
+_COMSOL_GROUPS = {
+    "AW": "anode_weights",
+    "CW": "cathode_weights",
+    "DW": "drift_weights",
+    "E": "electric_fields",
+}
+
+# Number of bytes read from the top of a COMSOL file to find its header
+_COMSOL_HEADER_BYTES = 64 * 1024
+_COMSOL_HEADER = re.compile(r"(?:%.*(?:\n|$))*")
+_COMSOL_HEADER_LINE = re.compile(r"^%\s*([^:\n]+?)\s*:[ \t]*(.*?)\s*$", re.MULTILINE)
+
+
+def _parse_comsol_date(value: str) -> str:
+    """Convert a COMSOL date, e.g., `Jun 28 2024, 10:22`, to ISO format.
+
+    Args:
+        value (str): The date from the COMSOL file.
+
+    Returns:
+        str: The date in ISO format.
+    """
+    parsed_time = time.strptime(value, "%b %d %Y, %H:%M")
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", parsed_time)
+
+
+# The metadata read from the header of the COMSOL files, as the name in the
+# metadata and the function to parse the value, by the key in the header
+_COMSOL_METADATA_FIELDS = {
+    "Version": ("COMSOL_version", str),
+    "Date": ("date", _parse_comsol_date),
+    "Nodes": ("nodes", int),
+    "Expressions": ("expressions", int),
+    "Dimensions": ("dimensions", int),
+    "Length unit": ("length_unit", str),
+}
+
 
 def download_data(
     article_id: int,
     auth_token: str = "",
-    save_path: os.PathLike = os.getcwd(),
+    save_path: os.PathLike | None = None,
     verbose: bool = False,
+    num_connections: int = 4,
 ) -> None:
     """
     Download the weighting potentials and electric field data from the i-RASE project on the DTU Data platform.
@@ -31,42 +80,45 @@ def download_data(
     Args:
         article_id (int): The ID of the article to download the file from.
         auth_token (str): The authentication token for accessing private data. Defaults to an empty string.
-        save_path (os.PathLike, optional): The path to save the downloaded file. Defaults to the current working directory.
+        save_path (os.PathLike | None, optional): The path to save the downloaded file. Defaults to None, which is the current working directory.
         verbose (bool, optional): Whether to display verbose output. Defaults to False.
+        num_connections (int, optional): The number of parallel connections used to download the file, which is a single large file. Defaults to 4.
 
     Raises:
         RuntimeError: If the request to the API fails.
         RuntimeError: If the download of the file fails.
     """
 
-    logger = irase_data_manager.create_logger("download_weighting_potentials")
+    if save_path is None:
+        save_path = os.getcwd()
+
+    logger = create_logger("download_weighting_potentials")
     if verbose:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
 
-    url = f"https://api.figshare.com/v2/account/articles/{article_id}/files"
-    if auth_token == "":
+    if not auth_token:
         logger.debug("No authentication token provided. Assuming public data.")
-        url = f"https://api.figshare.com/v2/articles/{article_id}/files"
 
-    headers = {"Authorization": f"token {auth_token}"}
-    response = requests.get(url, headers=headers)
+    url, headers = figshare_files_url(article_id, auth_token)
+    response = get_session().get(url, headers=headers, timeout=TIMEOUT)
 
     logger.debug("Downloading data from the i-RASE project on the DTU Data platform")
 
-    if response.status_code != 200:
-        data = response.json()
-        raise RuntimeError(f"Failed to fetch data from {url}: {data}")
+    _expect(response, 200, f"Failed to fetch data from {url}")
 
     files = response.json()
 
     logger.debug(f"Found {len(files)} files in the response")
 
-    for file in files:
-        irase_data_manager.download_file(
-            file, save_path, auth_token=auth_token, verbose=verbose
-        )
+    download_files(
+        files,
+        save_path,
+        auth_token=auth_token,
+        verbose=verbose,
+        num_connections=num_connections,
+    )
 
 
 def upload_data(
@@ -75,179 +127,297 @@ def upload_data(
     size: tuple[float, float, float] = (40, 5, 40),
     step: tuple[float, float, float] = (0.1, 0.1, 0.1),
     verbose: bool = False,
+    deep_check: bool = False,
+    compression: str | Mapping[str, any] = "lzf",
 ) -> None:
     """
     Upload the weighting potentials and electric field data to the i-RASE project on the DTU Data platform.
 
     The data_path should be a directory containing the `.txt` files to upload. The expected txt files are `AW_3D.txt`, `CW_3D.txt`, `DW_3D.txt`, and `E_3D.txt`.
 
+    .. note::
+        Parsing the `.txt` files is slow, so the parsed data is cached next to them as `.txt.npy` files (e.g., `AW_3D.txt.npy`). The cache is used as long as it is newer than the `.txt` file.
+
+    .. note::
+        The data is stored as float32, which holds all the significant digits of the COMSOL exports.
+
+    .. note::
+        By default, the datasets are compressed with the LZF filter of h5py, which is fast but is not part of the HDF5 library. It is available wherever h5py is installed, but other HDF5 readers may need the LZF plugin. Other filters can be used with ``compression``, e.g., ``hdf5plugin.Bitshuffle(cname="lz4")`` from the `hdf5plugin` package, which compresses floating point grids better. The readers of the file then need the same plugin.
+
+    .. note::
+        The four files are parsed in separate processes. On platforms that start processes with `spawn` (Windows and macOS), the calling script must be guarded by ``if __name__ == "__main__":``.
+
     Args:
         auth_token (str): The authentication token for accessing the platform.
         data_path (os.PathLike): The path to the directory containing the data files.
         verbose (bool, optional): Whether to display verbose output. Defaults to False.
+        deep_check (bool, optional): Whether to validate the grid of the files using every row, instead of a few known rows. Slower, but catches more malformed files. The reshaped data is also checked, as when ``verbose`` is True. Defaults to False.
+        compression (str | Mapping[str, any], optional): The compression of the datasets. Either the name of an h5py filter, applied after the shuffle filter, or the keyword arguments of a filter for ``create_dataset``, such as the filters of `hdf5plugin`. Defaults to "lzf".
 
     Raises:
         RuntimeError: If the upload of the file fails.
     """
-    logger = irase_data_manager.create_logger("upload_weighting_potentials")
+    logger = create_logger("upload_weighting_potentials")
 
     if verbose:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
 
-    num_x_steps = int(size[0] / step[0]) + 1  # +1 to include the last point
-    num_y_steps = int(size[1] / step[1]) + 1
-    num_z_steps = int(size[2] / step[2]) + 1
-
-    logger.debug("Uploading data to the i-RASE project on the DTU Data platform")
-
-    aw_metadata = _extract_comsol_metadata(os.path.join(data_path, "AW_3D.txt"))
+    num_x_steps, num_y_steps, num_z_steps = _grid_shape(size, step)
 
-    num_anodes = aw_metadata["expressions"]
-
-    logger.debug(
-        f"Extracted metadata from {os.path.join(data_path, 'AW_3D.txt')}: {aw_metadata}"
-    )
+    # Checking the reshaped data reads it back from the file, so it is only done
+    # when debugging or checking the files thoroughly
+    check_reshape = deep_check or logger.isEnabledFor(logging.DEBUG)
 
-    logger.debug(f"Reading data from {os.path.join(data_path, 'AW_3D.txt')}")
+    logger.debug("Uploading data to the i-RASE project on the DTU Data platform")
 
-    # Load the aw data
-    anode_weights_data = np.loadtxt(
-        os.path.join(data_path, "AW_3D.txt"), comments="%", dtype=np.float64
-    )
-    _check_input_values(size, step, num_anodes, anode_weights_data)
+    paths = {name: os.path.join(data_path, f"{name}_3D.txt") for name in _COMSOL_GROUPS}
+
+    # The files are independent, so they are parsed and checked in parallel. The
+    # parsed data is only returned through the .npy caches, which are cheap to open
+    with ProcessPoolExecutor(max_workers=len(paths)) as executor:
+        futures = {
+            name: executor.submit(
+                _parse_comsol_file,
+                path,
+                size,
+                step,
+                (num_x_steps, num_y_steps, num_z_steps),
+                deep_check,
+            )
+            for name, path in paths.items()
+        }
 
-    anode_weights_data = _reshape_data(
-        anode_weights_data, num_x_steps, num_y_steps, num_z_steps, num_anodes
-    )
-
-    logger.debug(f"Anode weights data shape: {anode_weights_data.shape}")
+    file_path = os.path.join(data_path, "weightingPotential_electricFields.hdf5")
 
-    cw_metadata = _extract_comsol_metadata(os.path.join(data_path, "CW_3D.txt"))
+    # The data is reshaped straight into the datasets, one slab at a time, so the
+    # reshaped data is never held in memory. The chunk cache fits a whole slab
+    with h5py.File(
+        file_path,
+        "w",
+        libver="latest",
+        rdcc_nbytes=_RESHAPE_SLAB_BYTES,
+        rdcc_nslots=10007,
+    ) as f:
+        for name, group_name in _COMSOL_GROUPS.items():
+            metadata = futures[name].result()
+
+            num_values = metadata["expressions"]
+
+            logger.debug(f"Extracted metadata from {paths[name]}: {metadata}")
+
+            logger.debug(f"Reading data from {paths[name]}")
+
+            data = _load_grid_txt(
+                paths[name],
+                num_x_steps * num_y_steps * num_z_steps,
+                num_values + 3,
+            )
+
+            group = f.create_group(group_name)
+            group.attrs.update(metadata)
+
+            dataset = _create_grid_dataset(
+                group,
+                (num_values, num_x_steps, num_y_steps, num_z_steps),
+                data.dtype,
+                compression,
+            )
+            _reshape_data(
+                data,
+                num_x_steps,
+                num_y_steps,
+                num_z_steps,
+                num_values,
+                out=dataset,
+                check=check_reshape,
+            )
+
+            logger.debug(f"{group_name} data shape: {dataset.shape}")
 
-    num_cathodes = cw_metadata["expressions"]
+        # Add the metadata for size and steps
+        f.attrs.update(
+            {
+                "x_size": size[0],
+                "y_size": size[1],
+                "z_size": size[2],
+                "x_step": step[0],
+                "y_step": step[1],
+                "z_step": step[2],
+            }
+        )
 
     logger.debug(
-        f"Extracted metadata from {os.path.join(data_path, 'CW_3D.txt')}: {cw_metadata}"
-    )
-
-    cathode_weights_data = np.loadtxt(
-        os.path.join(data_path, "CW_3D.txt"), comments="%", dtype=np.float64
+        f"File saved to {file_path}. Uploading data to the i-RASE project on the DTU Data platform"
     )
 
-    _check_input_values(size, step, num_cathodes, cathode_weights_data)
+    headers = {"Authorization": f"token {auth_token}"}
+    article_metadata = {
+        "title": "Weighting potentials and electric field data for the i-RASE ATDM",
+        "description": "Weighting potentials and electric field data for the i-RASE 3DCZT Advanced Theoretical Data Model (ATDM), in a single .hdf5 file containing the data and metadata.",
+        "keywords": ["weighting potentials", "electric field", "i-RASE 3DCZT"],
+        "categories": [30103, 30091, 30262],
+        "authors": [{"id": 6659987}],
+        "license": 1,
+        "defined_type": "dataset",
+    }
 
-    cathode_weights_data = _reshape_data(
-        cathode_weights_data, num_x_steps, num_y_steps, num_z_steps, num_cathodes
+    create_article_url = "https://api.figshare.com/v2/account/projects/211264/articles"
+    response = get_session().post(
+        create_article_url, headers=headers, json=article_metadata, timeout=TIMEOUT
     )
 
-    logger.debug(f"Cathode weights data shape: {cathode_weights_data.shape}")
+    _expect(response, 201, "Failed to create article")
 
-    dw_metadata = _extract_comsol_metadata(os.path.join(data_path, "DW_3D.txt"))
+    article_id = response.json()["entity_id"]
 
-    num_drifts = dw_metadata["expressions"]
+    logger.debug(f"Created article with ID {article_id}")
 
-    logger.debug(
-        f"Extracted metadata from {os.path.join(data_path, 'DW_3D.txt')}: {dw_metadata}"
-    )
+    upload_file(file_path, auth_token, article_id, verbose=verbose)
 
-    drift_weights_data = np.loadtxt(
-        os.path.join(data_path, "DW_3D.txt"), comments="%", dtype=np.float64
-    )
+    logger.debug(f"Data uploaded successfully with article ID {article_id}")
 
-    _check_input_values(size, step, num_drifts, drift_weights_data)
 
-    drift_weights_data = _reshape_data(
-        drift_weights_data, num_x_steps, num_y_steps, num_z_steps, num_drifts
-    )
+def _grid_shape(
+    size: tuple[float, float, float], step: tuple[float, float, float]
+) -> tuple[int, int, int]:
+    """Compute the number of points of the grid in each dimension.
 
-    logger.debug(f"Drift weights data shape: {drift_weights_data.shape}")
+    Args:
+        size (tuple[float, float, float]): The size of the grid in each dimension.
+        step (tuple[float, float, float]): The step of the grid in each dimension.
 
-    e_metadata = _extract_comsol_metadata(os.path.join(data_path, "E_3D.txt"))
+    Returns:
+        tuple[int, int, int]: The number of points in each dimension, including the last point.
+    """
+    return tuple(int(length / spacing) + 1 for length, spacing in zip(size, step))
 
-    logger.debug(
-        f"Extracted metadata from {os.path.join(data_path, 'E_3D.txt')}: {e_metadata}"
-    )
 
-    num_electric_fields = e_metadata["expressions"]
+def _parse_comsol_file(
+    file_path: os.PathLike,
+    size: tuple[float, float, float],
+    step: tuple[float, float, float],
+    grid_shape: tuple[int, int, int],
+    deep_check: bool = False,
+) -> dict[str, any]:
+    """Parse a COMSOL `.txt` file into its `.npy` cache and check its grid.
 
-    electric_fields_data = np.loadtxt(
-        os.path.join(data_path, "E_3D.txt"), comments="%", dtype=np.float64
-    )
+    This is run in a separate process for each file. Only the metadata is returned, as sending the data back to the main process would mean copying it, while the cache can be memory-mapped with :func:`_load_grid_txt`.
+
+    Args:
+        file_path (os.PathLike): The path to the `.txt` file.
+        size (tuple[float, float, float]): The size of the grid in each dimension.
+        step (tuple[float, float, float]): The step of the grid in each dimension.
+        grid_shape (tuple[int, int, int]): The number of points of the grid in each dimension, from :func:`_grid_shape`.
+        deep_check (bool, optional): Whether to check the grid using every row. Defaults to False.
 
-    _check_input_values(size, step, num_electric_fields, electric_fields_data)
+    Returns:
+        dict[str, any]: The metadata of the file.
+    """
+    metadata = _extract_comsol_metadata(file_path)
 
-    electric_fields_data = _reshape_data(
-        electric_fields_data, num_x_steps, num_y_steps, num_z_steps, num_electric_fields
+    data = _load_grid_txt(file_path, math.prod(grid_shape), metadata["expressions"] + 3)
+    _check_input_values(
+        size, step, metadata["expressions"], data, grid_shape, deep_check=deep_check
     )
 
-    file_path = os.path.join(data_path, "weightingPotential_electricFields.hdf5")
+    return metadata
 
-    with h5py.File(file_path, "w") as f:
-        # Create a group for the weighting potentials
-        aw_group = f.create_group("anode_weights")
-        for key, value in aw_metadata.items():
-            aw_group.attrs[key] = value
 
-        aw_group.create_dataset("data", data=anode_weights_data)
+def _load_grid_txt(
+    file_path: os.PathLike, num_rows: int, num_columns: int
+) -> np.ndarray:
+    """Load the data of a COMSOL `.txt` file, using a `.npy` cache of the parsed data.
 
-        cw_group = f.create_group("cathode_weights")
-        for key, value in cw_metadata.items():
-            cw_group.attrs[key] = value
+    The file is parsed with the C parser of pandas, and the result is saved next to it as `<file_path>.npy`. The size and modification time of the `.txt` file are saved with the cache, as `<file_path>.npy.source`. If both are exactly the same the next time, the cache is memory-mapped instead of parsing the file again. Otherwise, e.g., if the file was replaced by an export that kept an older modification time, the file is parsed again.
 
-        cw_group.create_dataset("data", data=cathode_weights_data)
+    The file is parsed in blocks of rows, written straight into the memory-mapped cache, so the whole data is never held in memory while parsing.
 
-        dw_group = f.create_group("drift_weights")
-        for key, value in dw_metadata.items():
-            dw_group.attrs[key] = value
+    The data is stored as float32: COMSOL exports do not have more significant digits than float32 can hold, and it halves the memory and disk used by the data.
 
-        dw_group.create_dataset("data", data=drift_weights_data)
+    Args:
+        file_path (os.PathLike): The path to the COMSOL file.
+        num_rows (int): The expected number of rows (nodes) of the file.
+        num_columns (int): The expected number of columns of the file, including the coordinates.
 
-        e_group = f.create_group("electric_fields")
-        for key, value in e_metadata.items():
-            e_group.attrs[key] = value
+    Returns:
+        np.ndarray: The float32 data of the file, with one row per node, memory-mapped from the cache.
 
-        e_group.create_dataset("data", data=electric_fields_data)
+    Raises:
+        AssertionError: If the number of rows or columns of the file is not the expected one.
+    """
+    cache_path = f"{file_path}.npy"
+    source_path = f"{cache_path}.source"
 
-        # Add the metadata for size and steps
-        f.attrs["x_size"] = size[0]
-        f.attrs["y_size"] = size[1]
-        f.attrs["z_size"] = size[2]
+    file_stat = os.stat(file_path)
+    source = {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
 
-        f.attrs["x_step"] = step[0]
-        f.attrs["y_step"] = step[1]
-        f.attrs["z_step"] = step[2]
+    if os.path.exists(cache_path) and _read_cache_source(source_path) == source:
+        return np.load(cache_path, mmap_mode="r")
 
-    logger.debug(
-        f"File saved to {file_path}. Uploading data to the i-RASE project on the DTU Data platform"
+    # Parse into a temporary file, so an interrupted parse does not leave a cache
+    temporary_path = f"{cache_path}.tmp"
+    data = np.lib.format.open_memmap(
+        temporary_path, mode="w+", dtype=np.float32, shape=(num_rows, num_columns)
     )
 
-    headers = {"Authorization": f"token {auth_token}"}
-    article_metadata = {
-        "title": "Weighting potentials and electric field data for the i-RASE ATDM",
-        "description": "Weighting potentials and electric field data for the i-RASE 3DCZT Advanced Theoretical Data Model (ATDM), in a single .hdf5 file containing the data and metadata.",
-        "keywords": ["weighting potentials", "electric field", "i-RASE 3DCZT"],
-        "categories": [30103, 30091, 30262],
-        "authors": [{"id": 6659987}],
-        "license": 1,
-        "defined_type": "dataset",
-    }
-
-    create_article_url = "https://api.figshare.com/v2/account/projects/211264/articles"
-    response = requests.post(create_article_url, headers=headers, json=article_metadata)
-
-    if response.status_code != 201:
-        data = response.json()
-        raise RuntimeError(f"Failed to create article: {data}")
-
-    article_id = response.json()["entity_id"]
-
-    logger.debug(f"Created article with ID {article_id}")
+    written = False
+    try:
+        position = 0
+        with pd.read_csv(
+            file_path,
+            comment="%",
+            sep=r"\s+",
+            header=None,
+            dtype=np.float32,
+            engine="c",
+            chunksize=1_000_000,
+        ) as reader:
+            for chunk in reader:
+                assert (
+                    chunk.shape[1] == num_columns
+                ), f"The number of columns is not equal to the data. Expected {num_columns}, got {chunk.shape[1]}"
+                assert (
+                    position + len(chunk) <= num_rows
+                ), f"The number of steps and the number of values are not the same. Expected {num_rows}, got more"
+
+                data[position : position + len(chunk)] = chunk.to_numpy()
+                position += len(chunk)
+
+        assert (
+            position == num_rows
+        ), f"The number of steps and the number of values are not the same. Expected {num_rows}, got {position}"
+
+        data.flush()
+        written = True
+    finally:
+        del data
+        if not written:
+            os.remove(temporary_path)
+
+    os.replace(temporary_path, cache_path)
+
+    with open(source_path, "w") as f:
+        json.dump(source, f)
+
+    return np.load(cache_path, mmap_mode="r")
+
+
+def _read_cache_source(source_path: os.PathLike) -> dict[str, int] | None:
+    """Read the size and modification time of the file a `.npy` cache was parsed from.
 
-    irase_data_manager.upload_file(file_path, auth_token, article_id, verbose=verbose)
+    Args:
+        source_path (os.PathLike): The path to the `.source` file of the cache.
 
-    logger.debug(f"Data uploaded successfully with article ID {article_id}")
+    Returns:
+        dict[str, int] | None: The size and modification time (in nanoseconds) of the parsed file, or None if the `.source` file does not exist or can not be read.
+    """
+    try:
+        with open(source_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
 
 def _reshape_data(
@@ -256,7 +426,9 @@ def _reshape_data(
     num_y_steps: int,
     num_z_steps: int,
     num_values: int,
-) -> np.ndarray:
+    out: np.ndarray | h5py.Dataset | None = None,
+    check: bool = True,
+) -> np.ndarray | h5py.Dataset:
     """Reshape the data to the correct shape. The data is expected to be in the format:
 
     x, y, z, value1, value2, ..., valueN
@@ -269,7 +441,7 @@ def _reshape_data(
 
     id, x, y, z
 
-    For that, the fortran order is used to match the order of the data, and then the data is transposed to match the order of the data.
+    As x changes the fastest, followed by y and z, the values are already laid out as (num_z_steps, num_y_steps, num_x_steps, num_values) in C order, so they are reshaped to that shape without copying and then transposed. The result is copied into the output in slabs of z values, through a single reusable buffer when the output is a dataset, so only a slab of the input is read at a time when it is memory-mapped, and only a slab is held in memory when the output is a dataset.
 
     It has to end up being a 4d array with the shape (num_values, num_x_steps, num_y_steps, num_z_steps).
 
@@ -279,19 +451,95 @@ def _reshape_data(
         num_y_steps (int): The number of y steps.
         num_z_steps (int): The number of z steps.
         num_values (int): The number of values. Can be anodes, cathodes, drifts, etc.
+        out (np.ndarray | h5py.Dataset | None, optional): The array or dataset to write the reshaped data to, e.g., from :func:`_create_grid_dataset`. Defaults to None, which allocates a new array.
+        check (bool, optional): Whether to check the reshaped data with :func:`_check_reshaped_data`. Defaults to True.
 
     Returns:
-        np.ndarray: The reshaped data.
+        np.ndarray | h5py.Dataset: The reshaped data.
     """
-    reshaped_data = (
-        data[:, 3:]
-        .reshape(num_x_steps, num_y_steps, num_z_steps, num_values, order="F")
-        .transpose(3, 0, 1, 2)
+    if out is None:
+        out = np.empty(
+            (num_values, num_x_steps, num_y_steps, num_z_steps), dtype=data.dtype
+        )
+
+    rows_per_z_step = num_x_steps * num_y_steps
+    z_steps_per_slab = max(
+        1, _RESHAPE_SLAB_BYTES // (rows_per_z_step * data.shape[1] * data.itemsize)
     )
 
-    _check_reshaped_data(reshaped_data, data, num_x_steps, num_y_steps)
+    # h5py needs contiguous data to write, so the slabs are transposed into a
+    # buffer that is reused and written as is, instead of a new copy of every slab
+    if isinstance(out, np.ndarray):
+        slab = None
+    else:
+        slab = np.empty(
+            (num_values, num_x_steps, num_y_steps, min(z_steps_per_slab, num_z_steps)),
+            dtype=out.dtype,
+        )
+
+    for z_start in range(0, num_z_steps, z_steps_per_slab):
+        z_end = min(z_start + z_steps_per_slab, num_z_steps)
+        values = (
+            data[z_start * rows_per_z_step : z_end * rows_per_z_step, 3:]
+            .reshape(z_end - z_start, num_y_steps, num_x_steps, num_values)
+            .transpose(3, 2, 1, 0)
+        )
+
+        if slab is None:
+            np.copyto(out[:, :, :, z_start:z_end], values)
+        else:
+            np.copyto(slab[:, :, :, : z_end - z_start], values)
+            out.write_direct(
+                slab,
+                source_sel=np.s_[:, :, :, : z_end - z_start],
+                dest_sel=np.s_[:, :, :, z_start:z_end],
+            )
+
+    if check:
+        _check_reshaped_data(out, data, num_x_steps, num_y_steps)
+
+    return out
+
+
+def _create_grid_dataset(
+    group: h5py.Group,
+    shape: tuple[int, int, int, int],
+    dtype: np.dtype,
+    compression: str | Mapping[str, any] = "lzf",
+) -> h5py.Dataset:
+    """Create the empty dataset of a reshaped grid, of shape `(num_values, x, y, z)`, to be filled by :func:`_reshape_data`.
 
-    return reshaped_data
+    Each chunk holds the full grid of a single value if it fits in the 1 MB default chunk cache of HDF5, so reading the grid of a value is a single chunk read. Otherwise, each chunk holds a single z step of the grid of a value, so the slabs written by :func:`_reshape_data` cover whole chunks.
+
+    Args:
+        group (h5py.Group): The group where the dataset is created, as `data`.
+        shape (tuple[int, int, int, int]): The shape of the dataset.
+        dtype (np.dtype): The data type of the dataset.
+        compression (str | Mapping[str, any], optional): The name of an h5py filter, applied after the shuffle filter, or the keyword arguments of a filter, e.g., ``hdf5plugin.Bitshuffle()``. Defaults to "lzf".
+
+    Returns:
+        h5py.Dataset: The created dataset.
+    """
+    _, num_x_steps, num_y_steps, num_z_steps = shape
+
+    if num_x_steps * num_y_steps * num_z_steps * np.dtype(dtype).itemsize <= 1 << 20:
+        chunks = (1, num_x_steps, num_y_steps, num_z_steps)
+    else:
+        chunks = (1, num_x_steps, num_y_steps, 1)
+
+    if isinstance(compression, str):
+        filters = {"compression": compression, "shuffle": True}
+    else:
+        filters = dict(compression)
+
+    return group.create_dataset(
+        "data",
+        shape=shape,
+        dtype=dtype,
+        chunks=chunks,
+        track_times=False,
+        **filters,
+    )
 
 
 def _check_input_values(
@@ -299,12 +547,14 @@ def _check_input_values(
     step: tuple[float, float, float],
     num_values: int,
     data: np.ndarray,
+    grid_shape: tuple[int, int, int],
+    deep_check: bool = False,
 ) -> None:
     """Check that the input values are correct. That means, the size, step, and number of values are correct.
 
     These checks that the number of steps and the number of values are the same, and that the number of columns is equal to the number of values.
 
-    Also, check that the step is correct and that the size is correct.
+    Also, check that the step is correct and that the size is correct. As the data is expected to follow the layout described in :func:`_reshape_data`, the steps and sizes are read from a few known rows instead of scanning the whole data. With ``deep_check``, the coordinates of every row are also compared with the coordinates of its point of the grid, which catches rows out of order too.
 
     These are not exhaustive checks, but they are a good start.
 
@@ -313,13 +563,16 @@ def _check_input_values(
         step (tuple[float, float, float]): The step of the data.
         num_values (int): The number of values. Can be anodes, cathodes, drifts, etc.
         data (np.ndarray): The data to check.
+        grid_shape (tuple[int, int, int]): The number of points of the grid in each dimension, from :func:`_grid_shape`.
+        deep_check (bool, optional): Whether to also check the coordinates of every row. Defaults to False.
 
     Raises:
         AssertionError: If the input values are not correct.
     """
-    num_x_steps = int(size[0] / step[0]) + 1  # +1 to include the last point
-    num_y_steps = int(size[1] / step[1]) + 1
-    num_z_steps = int(size[2] / step[2]) + 1
+    num_x_steps, num_y_steps, num_z_steps = grid_shape
+
+    # float32 coordinates are only accurate up to a few units in the last place
+    atol = max(1e-8, 8 * np.finfo(data.dtype).eps * max(size))
 
     assert num_x_steps * num_y_steps * num_z_steps == len(
         data
@@ -329,27 +582,62 @@ def _check_input_values(
         data.shape[1] == num_values + 3
     ), f"The number of columns is not equal to the data. Expected {data.shape[1]}, got {num_values + 3}"
 
-    # Check that the step is correct
-    assert np.allclose(
-        np.diff(data[:, 0]).max(), step[0]
-    ), f"Expected x step {np.diff(data[:, 0]).max()}, got {step[0]}"
-    assert np.allclose(
-        np.diff(data[:, 1]).max(), step[1]
-    ), f"Expected y step {np.diff(data[:, 1]).max()}, got {step[1]}"
-    assert np.allclose(
-        np.diff(data[:, 2]).max(), step[2]
-    ), f"Expected z step {np.diff(data[:, 2]).max()}, got {step[2]}"
-
-    # Check that the size is correct
-    assert np.allclose(
-        data[:, 0].max(), size[0]
-    ), f"Expected x size {data[:, 0].max()}, got {size[0]}"
-    assert np.allclose(
-        data[:, 1].max(), size[1]
-    ), f"Expected y size {data[:, 1].max()}, got {size[1]}"
-    assert np.allclose(
-        data[:, 2].max(), size[2]
-    ), f"Expected z size {data[:, 2].max()}, got {size[2]}"
+    # Check that the step is correct, from the first change of each coordinate
+    x_step = data[1, 0] - data[0, 0]
+    y_step = data[num_x_steps, 1] - data[0, 1]
+    z_step = data[num_x_steps * num_y_steps, 2] - data[0, 2]
+    assert math.isclose(
+        x_step, step[0], rel_tol=1e-9, abs_tol=atol
+    ), f"Expected x step {x_step}, got {step[0]}"
+    assert math.isclose(
+        y_step, step[1], rel_tol=1e-9, abs_tol=atol
+    ), f"Expected y step {y_step}, got {step[1]}"
+    assert math.isclose(
+        z_step, step[2], rel_tol=1e-9, abs_tol=atol
+    ), f"Expected z step {z_step}, got {step[2]}"
+
+    # Check that the size is correct, from the last row, which holds the last value
+    # of every coordinate
+    x_size = data[-1, 0]
+    y_size = data[-1, 1]
+    z_size = data[-1, 2]
+    assert math.isclose(
+        x_size, size[0], rel_tol=1e-9, abs_tol=atol
+    ), f"Expected x size {x_size}, got {size[0]}"
+    assert math.isclose(
+        y_size, size[1], rel_tol=1e-9, abs_tol=atol
+    ), f"Expected y size {y_size}, got {size[1]}"
+    assert math.isclose(
+        z_size, size[2], rel_tol=1e-9, abs_tol=atol
+    ), f"Expected z size {z_size}, got {size[2]}"
+
+    if not deep_check:
+        return
+
+    # Check that every row holds the coordinates of its point of the grid. The
+    # data is checked in slabs of z values, as it is reshaped
+    x_coordinates = np.arange(num_x_steps) * step[0]
+    y_coordinates = (np.arange(num_y_steps) * step[1])[:, np.newaxis]
+
+    rows_per_z_step = num_x_steps * num_y_steps
+    z_steps_per_slab = max(
+        1, _RESHAPE_SLAB_BYTES // (rows_per_z_step * data.shape[1] * data.itemsize)
+    )
+
+    for z_start in range(0, num_z_steps, z_steps_per_slab):
+        z_end = min(z_start + z_steps_per_slab, num_z_steps)
+        coordinates = data[
+            z_start * rows_per_z_step : z_end * rows_per_z_step, :3
+        ].reshape(z_end - z_start, num_y_steps, num_x_steps, 3)
+        z_coordinates = (np.arange(z_start, z_end) * step[2])[:, np.newaxis, np.newaxis]
+
+        for axis, (name, expected) in enumerate(
+            (("x", x_coordinates), ("y", y_coordinates), ("z", z_coordinates))
+        ):
+            mismatch = ~np.isclose(coordinates[..., axis], expected, rtol=0, atol=atol)
+            assert (
+                not mismatch.any()
+            ), f"Expected {name} coordinate {np.broadcast_to(expected, mismatch.shape).flat[mismatch.argmax()]}, got {coordinates[..., axis].flat[mismatch.argmax()]} at row {z_start * rows_per_z_step + mismatch.argmax()}"
 
 
 def _check_reshaped_data(
@@ -371,17 +659,17 @@ def _check_reshaped_data(
     Raises:
         AssertionError: If the reshaped data is not correct.
     """
-    assert np.all(
-        reshaped_data[:, 0, 0, 0] == original_data[0, 3:]
+    assert np.array_equal(
+        reshaped_data[:, 0, 0, 0], original_data[0, 3:]
     ), f"Expected {original_data[0, 3]}, got {reshaped_data[:, 0, 0, 0]}"
-    assert np.all(
-        reshaped_data[:, 1, 0, 0] == original_data[1, 3:]
+    assert np.array_equal(
+        reshaped_data[:, 1, 0, 0], original_data[1, 3:]
     ), f"Expected {original_data[1, 3]}, got {reshaped_data[:, 1, 0, 0]}"
-    assert np.all(
-        reshaped_data[:, 0, 1, 0] == original_data[num_x_steps, 3:]
+    assert np.array_equal(
+        reshaped_data[:, 0, 1, 0], original_data[num_x_steps, 3:]
     ), f"Expected {original_data[num_x_steps, 3]}, got {reshaped_data[:, 0, 1, 0]}"
-    assert np.all(
-        reshaped_data[:, 0, 0, 1] == original_data[num_x_steps * num_y_steps, 3:]
+    assert np.array_equal(
+        reshaped_data[:, 0, 0, 1], original_data[num_x_steps * num_y_steps, 3:]
     ), f"Expected {original_data[num_x_steps * num_y_steps, 3]}, got {reshaped_data[:, 0, 0, 1]}"
 
 
@@ -398,37 +686,16 @@ def _extract_comsol_metadata(file_path: os.PathLike) -> dict[str, any]:
         dict[str, any]: The extracted metadata.
     """
 
+    with open(file_path, "rb") as f:
+        head = f.read(_COMSOL_HEADER_BYTES).decode("utf-8", "replace")
+
+    # The header is every line at the top starting with `%`, as `% key: value`
+    header = _COMSOL_HEADER.match(head).group()
+
     metadata = {}
+    for key, value in _COMSOL_HEADER_LINE.findall(header):
+        if key in _COMSOL_METADATA_FIELDS:
+            name, parse = _COMSOL_METADATA_FIELDS[key]
+            metadata[name] = parse(value)
 
-    with open(file_path, "r") as f:
-        # Read only until the line does not start with `%`
-        stop_reading = False
-        while not stop_reading:
-            line = f.readline().strip()
-            if line.startswith("%"):
-                # The loine structure is `% key: value`
-                key, *value = line[1:].split(":")
-                # Some lines, like time, have a colon in the value, so we join the value
-                value = ":".join(value).strip()
-                # Strip also the key to remove any extra spaces
-                key = key.strip()
-                if key == "Version":
-                    metadata["COMSOL_version"] = value
-                elif key == "Date":
-                    # Save the date in ISO format
-                    parsed_time = time.strptime(value, "%b %d %Y, %H:%M")
-                    iso_date = time.strftime("%Y-%m-%dT%H:%M:%SZ", parsed_time)
-                    metadata["date"] = iso_date
-                elif key == "Nodes":
-                    metadata["nodes"] = int(value)
-                elif key == "Expressions":
-                    metadata["expressions"] = int(value)
-                elif key == "Dimensions":
-                    metadata["dimensions"] = int(value)
-                elif key == "Length unit":
-                    metadata["length_unit"] = value
-
-            else:
-                stop_reading = True
-
-        return metadata
+    return metadata
@@ -2,11 +2,42 @@
 Auxiliary files fro upload and download documents
 """
 
+import hashlib
 import logging
+import mmap
 import os
+import shutil
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+import urllib3
+from ._http import get_session, TIMEOUT, auth_headers
 from tqdm import tqdm
 
+# Number of bytes read from the response at once while downloading
+_DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Minimum size in bytes of a file to download it in parallel ranges
+_RANGE_DOWNLOAD_MIN_SIZE = 64 * 1024 * 1024
+
+# Number of attempts to upload a part of a file, and the delay in seconds before
+# the first retry, doubled after every failed attempt
+_UPLOAD_PART_ATTEMPTS = 3
+_UPLOAD_PART_BACKOFF = 0.3
+
+
+# The defaults of the optional metadata of an article, see extract_article_metadata
+_ARTICLE_DEFAULTS = {
+    "keywords": ("scan data",),
+    "categories": (30103, 30091, 30262),
+    "license": 1,
+    "defined_type": "dataset",
+}
+
+# The metadata every experiment must have, see validate_experiment_metadata
+_REQUIRED_METADATA = ("detector_id", "source_id", "experiment_type", "sample_time")
+
 
 def create_logger(logger_name: str):
     """Create a logger with the specified name. The format of the logger is as follows:
@@ -15,12 +46,17 @@ def create_logger(logger_name: str):
 
         [%(asctime)s] - [%(name)s] - [%(levelname)s] - %(message)s
 
+    Loggers are shared by name, so the handler is only added the first time a logger is created. Calling this function again with the same name returns the same logger, without duplicating its output.
+
     Args:
         logger_name (str): The name of the logger.
     """
     logger = logging.getLogger(logger_name)
     logger.setLevel(logging.DEBUG)
 
+    if logger.handlers:
+        return logger
+
     formatter = logging.Formatter(
         "[%(asctime)s] - [%(name)s] - [%(levelname)s] - %(message)s"
     )
@@ -61,23 +97,21 @@ def extract_article_metadata(metadata: dict[str, any]) -> dict[str, any]:
     Returns:
         dict[str, any]: The extracted metadata of the article.
     """
-    defaults = {
-        "keywords": ["scan data"],
-        "categories": [30103, 30091, 30262],
-        "license": 1,
-        "defined_type": "dataset",
-    }
-
     article_metadata = {
         "title": metadata.pop("title"),
         "description": metadata.pop("description"),
-        "keywords": metadata.pop("keywords", defaults["keywords"]),
-        "categories": metadata.pop("categories", defaults["categories"]),
+        "keywords": metadata.pop("keywords", None),
+        "categories": metadata.pop("categories", None),
         "authors": [{"id": author_id} for author_id in metadata.pop("authors")],
-        "license": metadata.pop("license", defaults["license"]),
-        "defined_type": metadata.pop("type", defaults["defined_type"]),
+        "license": metadata.pop("license", _ARTICLE_DEFAULTS["license"]),
+        "defined_type": metadata.pop("type", _ARTICLE_DEFAULTS["defined_type"]),
     }
 
+    # The default lists are only built when they are used, as new lists
+    for key in ("keywords", "categories"):
+        if article_metadata[key] is None:
+            article_metadata[key] = list(_ARTICLE_DEFAULTS[key])
+
     return article_metadata
 
 
@@ -99,9 +133,7 @@ def validate_experiment_metadata(metadata: dict[str, any]) -> None:
     Raises:
         ValueError: If any of the required metadata is missing.
     """
-    required_metadata = ["detector_id", "source_id", "experiment_type", "sample_time"]
-
-    missing_metadata = [key for key in required_metadata if key not in metadata]
+    missing_metadata = [key for key in _REQUIRED_METADATA if key not in metadata]
 
     if missing_metadata:
         raise ValueError(f"Missing metadata: {missing_metadata}")
@@ -112,15 +144,26 @@ def download_file(
     save_path: os.PathLike,
     auth_token: str = "",
     verbose=False,
+    num_connections: int = 1,
 ):
     """Download a file obtained from an API request.
 
+    If ``num_connections`` is greater than 1 and the file is larger than 64 MiB, the file is split in byte ranges that are downloaded in parallel, each with its own connection, straight into the destination file. If the server does not support range requests, the file is downloaded with a single connection.
+
+    If the file already exists in ``save_path`` with the size and MD5 checksum given in ``file_data``, it is not downloaded again. To download it again anyway, delete the file first.
+
     Args:
         file_data (dict[str, any]): File data. Expected to follow the format of the response from the Figshare API.
         save_path (os.PathLike): The path to save the downloaded file. Expected to be a directory.
         auth_token (str): The authentication token for accessing private data.
+        verbose (bool, optional): Whether to display verbose output. Defaults to False.
+        num_connections (int, optional): The number of parallel connections used to download the file. Defaults to 1.
+
+    Raises:
+        ValueError: If the save path is not a directory.
+        RuntimeError: If the download of the file fails, including when the connection times out or is cut off while reading the content.
     """
-    logger = create_logger(f"download_file_{file_data['name']}")
+    logger = create_logger("download_file")
 
     if verbose:
         logger.setLevel(logging.DEBUG)
@@ -137,14 +180,28 @@ def download_file(
         raise ValueError(f"Invalid save path: {save_path}")
 
     url = file_data["download_url"]
-    headers = {"Authorization": f"token {auth_token}"}
-    response = requests.get(url, headers=headers, stream=True)
+    headers = auth_headers(auth_token)
+    file_path = os.path.join(save_path, file_data["name"])
 
-    if response.status_code != 200:
-        data = response.json()
-        raise RuntimeError(
-            f"Failed to download data from {file_data['download_url']}: {data}"
-        )
+    if _is_downloaded(file_path, file_data):
+        logger.debug(f"{file_data['name']} is already downloaded. Skipping.")
+        return
+
+    if num_connections > 1:
+        try:
+            if _download_file_ranges(
+                url, headers, file_path, num_connections, verbose=verbose
+            ):
+                logger.debug(f"Finished downloading {file_data['name']}")
+                return
+        except _RangeNotSupportedError:
+            logger.debug(
+                f"{url} does not support range requests. Downloading with a single connection."
+            )
+
+    response = get_session().get(url, headers=headers, stream=True, timeout=TIMEOUT)
+
+    _expect(response, 200, f"Failed to download data from {file_data['download_url']}")
 
     file_name = file_data["name"]
     file_size = int(response.headers.get("Content-Length", 0))
@@ -153,29 +210,278 @@ def download_file(
         f"Downloading {file_name} ({file_size/1024/1024/1024:.2f} GB) to {save_path}"
     )
 
-    with open(os.path.join(save_path, file_name), "wb") as f:
-        for chunk in tqdm(
-            response.iter_content(chunk_size=1024 * 1024),
-            total=file_size / 1024 / 1024,
-            unit="MB",
-            desc=f"Downloading {file_name}",
-            disable=not verbose,
-        ):
-            f.write(chunk)
+    # Copy the raw stream straight into the file, with the progress bar counting the
+    # written bytes. The session asks for every content encoding urllib3 can decode
+    # (gzip and deflate, plus brotli and zstd when installed), decoded here
+    response.raw.decode_content = True
+    with open(file_path, "wb") as f, tqdm.wrapattr(
+        f,
+        "write",
+        total=file_size or None,  # Unknown without a Content-Length
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=f"Downloading {file_name}",
+        disable=not verbose,
+    ) as wrapped_file:
+        if file_size > 0:
+            try:
+                # Reserve the whole file at once, instead of growing it on every write
+                os.posix_fallocate(f.fileno(), 0, file_size)
+            except (AttributeError, OSError):
+                # Not available on every platform and file system
+                pass
+
+        # Reading the raw stream skips the translation of the urllib3 errors that
+        # requests does in iter_content, e.g., of a stalled or cut off body
+        try:
+            shutil.copyfileobj(response.raw, wrapped_file, length=_DOWNLOAD_CHUNK_SIZE)
+        except urllib3.exceptions.HTTPError as error:
+            raise RuntimeError(
+                f"Failed to download {file_name} from {file_data['download_url']}: {error}"
+            ) from error
+
+        # Drop the reserved space left if the decoded content is shorter
+        f.truncate()
 
     logger.debug(f"Finished downloading {file_name}")
 
 
+def _is_downloaded(file_path: os.PathLike, file_data: dict[str, any]) -> bool:
+    """Check whether a file was already downloaded, by comparing its size and MD5 checksum with the file data from the Figshare API.
+
+    The size alone is not enough, as an interrupted range download leaves a file with the full size. Without a checksum in the file data, the file is considered not downloaded.
+
+    Args:
+        file_path (os.PathLike): The path of the downloaded file.
+        file_data (dict[str, any]): File data, with the ``size`` and ``computed_md5`` (or ``supplied_md5``) of the file.
+
+    Returns:
+        bool: True if the file exists and matches the file data.
+    """
+    expected_md5 = file_data.get("computed_md5") or file_data.get("supplied_md5")
+
+    if (
+        not expected_md5
+        or not os.path.isfile(file_path)
+        or os.path.getsize(file_path) != file_data.get("size")
+    ):
+        return False
+
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(_DOWNLOAD_CHUNK_SIZE):
+            md5.update(chunk)
+
+    return md5.hexdigest() == expected_md5
+
+
+class _RangeNotSupportedError(Exception):
+    """The server answered a range request with the full file."""
+
+
+def _download_file_ranges(
+    url: str,
+    headers: dict[str, str],
+    file_path: os.PathLike,
+    num_connections: int,
+    verbose: bool = False,
+) -> bool:
+    """Download a file in parallel byte ranges, writing each range in place in a memory map of the destination file.
+
+    Args:
+        url (str): The download URL of the file.
+        headers (dict[str, str]): The headers of the requests.
+        file_path (os.PathLike): The path to save the downloaded file.
+        num_connections (int): The number of ranges downloaded in parallel.
+        verbose (bool, optional): Whether to display the progress. Defaults to False.
+
+    Returns:
+        bool: True if the file was downloaded. False if its size is unknown or smaller than :data:`_RANGE_DOWNLOAD_MIN_SIZE`, or if the server does not advertise range support with ``Accept-Ranges: bytes``, so it should be downloaded with a single request.
+
+    Raises:
+        RuntimeError: If the download of any of the ranges fails.
+        _RangeNotSupportedError: If the server does not support range requests.
+    """
+    # The ranges are byte positions of the file as stored, so it must not be encoded
+    headers = {**headers, "Accept-Encoding": "identity"}
+
+    response = get_session().head(
+        url, headers=headers, allow_redirects=True, timeout=TIMEOUT
+    )
+    file_size = int(response.headers.get("Content-Length", 0))
+
+    # Small files are faster to download with a single request, and servers that
+    # do not advertise range support are not asked for ranges
+    if (
+        response.status_code != 200
+        or file_size < _RANGE_DOWNLOAD_MIN_SIZE
+        or response.headers.get("Accept-Ranges") != "bytes"
+    ):
+        return False
+
+    range_size = -(-file_size // num_connections)  # Ceiling division
+    ranges = [
+        (start, min(start + range_size, file_size) - 1)
+        for start in range(0, file_size, range_size)
+    ]
+
+    with open(file_path, "wb+") as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, file_size)
+        except (AttributeError, OSError):
+            # Not available on every platform and file system
+            f.truncate(file_size)
+
+        with mmap.mmap(f.fileno(), file_size) as file_map, tqdm(
+            total=file_size,
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+            desc=f"Downloading {os.path.basename(file_path)}",
+            disable=not verbose,
+        ) as progress_bar, ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [
+                executor.submit(
+                    _download_range, url, headers, file_map, start, end, progress_bar
+                )
+                for start, end in ranges
+            ]
+            for future in as_completed(futures):
+                future.result()
+
+    return True
+
+
+def _download_range(
+    url: str,
+    headers: dict[str, str],
+    file_map: mmap.mmap,
+    start: int,
+    end: int,
+    progress_bar: tqdm,
+):
+    """Download the bytes from ``start`` to ``end`` (both included) of a file into the same position of a memory map.
+
+    Args:
+        url (str): The download URL of the file.
+        headers (dict[str, str]): The headers of the request.
+        file_map (mmap.mmap): The memory map of the destination file.
+        start (int): The first byte of the range.
+        end (int): The last byte of the range.
+        progress_bar (tqdm): The progress bar to update with the downloaded bytes.
+
+    Raises:
+        RuntimeError: If the download of the range fails.
+        _RangeNotSupportedError: If the server answers with the full file.
+    """
+    response = get_session().get(
+        url,
+        headers={**headers, "Range": f"bytes={start}-{end}"},
+        stream=True,
+        timeout=TIMEOUT,
+    )
+
+    with response:
+        if response.status_code == 200:
+            raise _RangeNotSupportedError(url)
+
+        if response.status_code != 206:
+            raise RuntimeError(
+                f"Failed to download bytes {start}-{end} from {url}: {response.text}"
+            )
+
+        # The range is not encoded, so the raw stream is read without the
+        # iter_content generator
+        position = start
+        try:
+            while chunk := response.raw.read(_DOWNLOAD_CHUNK_SIZE):
+                file_map[position : position + len(chunk)] = chunk
+                position += len(chunk)
+                progress_bar.update(len(chunk))
+        except urllib3.exceptions.HTTPError as error:
+            raise RuntimeError(
+                f"Failed to download bytes {start}-{end} from {url}: {error}"
+            ) from error
+
+    if position != end + 1:
+        raise RuntimeError(
+            f"Failed to download bytes {start}-{end} from {url}: got {position - start} bytes"
+        )
+
+
+def download_files(
+    files: list[dict[str, any]],
+    save_path: os.PathLike,
+    auth_token: str = "",
+    verbose: bool = False,
+    max_workers: int = 8,
+    num_connections: int = 1,
+):
+    """Download several files obtained from an API request in parallel, using :func:`download_file` in a thread pool.
+
+    The progress is shown per file downloaded. If there is a single file, it is downloaded directly, showing its own progress.
+
+    Args:
+        files (list[dict[str, any]]): The data of the files. Expected to follow the format of the response from the Figshare API.
+        save_path (os.PathLike): The path to save the downloaded files. Expected to be a directory.
+        auth_token (str, optional): The authentication token for accessing private data. Defaults to "".
+        verbose (bool, optional): Whether to display verbose output. Defaults to False.
+        max_workers (int, optional): The maximum number of files downloaded at the same time. Defaults to 8.
+        num_connections (int, optional): The number of parallel connections used to download each file. See :func:`download_file`. Defaults to 1.
+
+    Raises:
+        RuntimeError: If the download of any of the files fails.
+    """
+    if len(files) == 0:
+        return
+
+    if len(files) == 1:
+        download_file(
+            files[0],
+            save_path,
+            auth_token=auth_token,
+            verbose=verbose,
+            num_connections=num_connections,
+        )
+        return
+
+    # Create the directory before the threads, so they do not race to create it
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+        futures = [
+            executor.submit(
+                download_file,
+                file,
+                save_path,
+                auth_token=auth_token,
+                num_connections=num_connections,
+            )
+            for file in files
+        ]
+        for future in tqdm(
+            as_completed(futures),
+            total=len(futures),
+            unit="file",
+            desc=f"Downloading {len(files)} files",
+            disable=not verbose,
+        ):
+            future.result()
+
+
 def upload_file(
     file_path: os.PathLike,
     auth_token: str,
     article_id: int,
     verbose: bool = False,
+    max_workers: int = 3,
 ):
     """Upload a file to an article on the Figshare platform. It is not a direct upload, as the file must be registered first before uploading the content. The process is as follows:
 
     1. Register the file with the Figshare API.
-    2. Upload the content of the file to the registered file, divided into chunks.
+    2. Upload the content of the file to the registered file, divided into chunks. The chunks are uploaded in parallel, and each one is retried a few times if it fails.
     3. Update the file with the Figshare API to mark it as complete.
 
     Args:
@@ -183,6 +489,7 @@ def upload_file(
         auth_token (str): The authentication token for accessing the platform.
         article_id (int): The ID of the article to upload the file to.
         verbose (bool, optional): Whether to display verbose output. Defaults to False.
+        max_workers (int, optional): The number of parts uploaded at the same time. Defaults to 3.
 
     Raises:
         RuntimeError: If the upload of the file fails.
@@ -191,7 +498,7 @@ def upload_file(
     file_name = os.path.basename(file_path)
     file_size = os.path.getsize(file_path)
 
-    logger = create_logger(f"upload_file_{file_name}")
+    logger = create_logger("upload_file")
 
     if verbose:
         logger.setLevel(logging.DEBUG)
@@ -203,67 +510,173 @@ def upload_file(
     headers = {"Authorization": f"token {auth_token}"}
 
     upload_file_url = f"https://api.figshare.com/v2/account/articles/{article_id}/files"
-    response = requests.post(
+    response = get_session().post(
         upload_file_url,
         headers=headers,
         json={"name": file_name, "size": file_size},
+        timeout=TIMEOUT,
     )
 
-    if response.status_code != 201:
-        data = response.json()
-        raise RuntimeError(
-            f"Failed to upload file {file_name} to article {article_id}: {data}"
-        )
+    _expect(response, 201, f"Failed to upload file {file_name} to article {article_id}")
 
     file_location_url = response.json()["location"]
-    response = requests.get(file_location_url, headers=headers)
+    response = get_session().get(file_location_url, headers=headers, timeout=TIMEOUT)
 
-    logger.debug(f"File registered successfully with Figshare API")
+    logger.debug(f"File {file_name} registered successfully with Figshare API")
 
-    if response.status_code != 200:
-        data = response.json()
-        raise RuntimeError(
-            f"Failed to get upload location for file {file_name}: {data}"
-        )
+    _expect(response, 200, f"Failed to get upload location for file {file_name}")
 
     upload_url = response.json()["upload_url"]
     file_id = response.json()["id"]
 
-    response = requests.get(upload_url, headers=headers)
+    response = get_session().get(upload_url, headers=headers, timeout=TIMEOUT)
 
-    if response.status_code != 200:
-        data = response.json()
-        raise RuntimeError(
-            f"Failed to get upload location for file {file_name}: {data}"
-        )
+    _expect(response, 200, f"Failed to get upload location for file {file_name}")
 
     logger.debug(f"Uploading content of {file_name} to {upload_url}")
 
-    with open(file_path, "rb") as f:
-        parts = response.json()["parts"]
-        for part in tqdm(parts, desc=f"Uploading {file_name}", disable=not verbose):
-            url = f"{upload_url}/{part['partNo']}"
-            f.seek(part["startOffset"])
-            data = f.read(part["endOffset"] - part["startOffset"] + 1)
-            response = requests.put(url, headers=headers, data=data)
-
-            if response.status_code != 200:
-                data = response.json()
-                raise RuntimeError(
-                    f"Failed to upload part {part['partNo']} of {file_name}: {data}"
+    parts = response.json()["parts"]
+    part_urls = [f"{upload_url}/{part['partNo']}" for part in parts]
+    part_ranges = [
+        (part["startOffset"], part["endOffset"] - part["startOffset"] + 1)
+        for part in parts
+    ]
+
+    # The parts are independent, so they are uploaded in parallel, each one read
+    # from a memory map of the file. An empty file has no parts, and can not be mapped
+    if parts:
+        with open(file_path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as file_map, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    _upload_part, url, headers, file_map, offset, size, file_name
                 )
+                for url, (offset, size) in zip(part_urls, part_ranges)
+            ]
+            for future in tqdm(
+                as_completed(futures),
+                total=len(futures),
+                desc=f"Uploading {file_name}",
+                disable=not verbose,
+            ):
+                future.result()
 
     logger.debug(f"Content of {file_name} uploaded successfully")
 
     close_file_url = (
         f"https://api.figshare.com/v2/account/articles/{article_id}/files/{file_id}"
     )
-    response = requests.post(close_file_url, headers=headers)
+    response = get_session().post(close_file_url, headers=headers, timeout=TIMEOUT)
 
-    if response.status_code != 202:
-        data = response.json()
-        raise RuntimeError(
-            f"Failed to close file {file_name} on article {article_id}: {data}"
-        )
+    _expect(response, 202, f"Failed to close file {file_name} on article {article_id}")
 
     logger.debug(f"File {file_name} uploaded successfully to article {article_id}")
+
+
+def _upload_part(
+    url: str,
+    headers: dict[str, str],
+    file_map: mmap.mmap,
+    offset: int,
+    size: int,
+    file_name: str,
+):
+    """Upload a part of a file to its URL of the Figshare upload API, from a memory map of the file.
+
+    The part is retried up to :data:`_UPLOAD_PART_ATTEMPTS` times with :func:`_expect_retry`.
+
+    Args:
+        url (str): The upload URL of the part.
+        headers (dict[str, str]): The headers of the request.
+        file_map (mmap.mmap): The memory map of the file.
+        offset (int): The position of the first byte of the part in the file.
+        size (int): The number of bytes of the part.
+        file_name (str): The name of the file, for the error messages.
+
+    Raises:
+        RuntimeError: If the upload of the part fails after all the attempts.
+    """
+    data = file_map[offset : offset + size]
+
+    _expect_retry(
+        lambda: get_session().put(url, headers=headers, data=data, timeout=TIMEOUT),
+        200,
+        f"Failed to upload bytes {offset}-{offset + size - 1} of {file_name} to {url}",
+    )
+
+
+def _expect(response: requests.Response, status_code: int, message: str) -> None:
+    """Check that a response has the expected status code.
+
+    Args:
+        response (requests.Response): The response to check.
+        status_code (int): The expected status code.
+        message (str): The message of the error, followed by the body of the response.
+
+    Raises:
+        RuntimeError: If the status code is not the expected one.
+    """
+    if response.status_code != status_code:
+        raise RuntimeError(f"{message}: {_response_error(response)}")
+
+
+def _expect_retry(
+    send: Callable[[], requests.Response],
+    status_code: int,
+    message: str,
+    attempts: int = _UPLOAD_PART_ATTEMPTS,
+    backoff: float = _UPLOAD_PART_BACKOFF,
+) -> requests.Response:
+    """Send a request until its response has the expected status code, with exponential backoff between attempts.
+
+    The request is retried if the connection fails, it times out or the status code is not the expected one, including when the retries of the session on the status codes of transient failures run out. This is on top of the retries of the session, which only cover some status codes.
+
+    Args:
+        send (Callable[[], requests.Response]): The function that sends the request.
+        status_code (int): The expected status code.
+        message (str): The message of the error, followed by the last error.
+        attempts (int, optional): The maximum number of attempts. Defaults to :data:`_UPLOAD_PART_ATTEMPTS`.
+        backoff (float, optional): The delay in seconds before the first retry, doubled after every failed attempt. Defaults to :data:`_UPLOAD_PART_BACKOFF`.
+
+    Returns:
+        requests.Response: The response with the expected status code.
+
+    Raises:
+        RuntimeError: If no attempt gets the expected status code.
+    """
+    for attempt in range(attempts):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+        try:
+            response = send()
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.RetryError,
+        ) as error:
+            last_error = error
+            continue
+
+        if response.status_code == status_code:
+            return response
+
+        last_error = _response_error(response)
+
+    raise RuntimeError(f"{message}: {last_error}")
+
+
+def _response_error(response: requests.Response) -> any:
+    """Get the error of a failed response, for the error messages.
+
+    Args:
+        response (requests.Response): The failed response.
+
+    Returns:
+        any: The JSON body of the response, or its text if the body is not JSON, e.g. an HTML error page of a proxy or an XML error of the storage server.
+    """
+    try:
+        return response.json()
+    except ValueError:
+        return response.text
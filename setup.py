@@ -10,5 +10,16 @@ setup(
     long_description_content_type="text/markdown",
     url="https://github.com/Pheithar/iRASE-data-manager",
     packages=find_packages(),
-    install_requires=[],
+    python_requires=">=3.10",
+    install_requires=[
+        "h5py>=3.8",
+        "numpy>=1.24",
+        "pandas>=2.0",
+        "requests>=2.31",
+        "tqdm>=4.65",
+    ],
+    extras_require={
+        # Extra compression filters for the simulator data, see upload_data
+        "hdf5plugin": ["hdf5plugin"],
+    },
 )